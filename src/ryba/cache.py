@@ -0,0 +1,83 @@
+import contextlib
+import json
+import os
+import pathlib
+import tempfile
+import typing as t
+
+import xdg
+
+
+def get_default_cache_path() -> pathlib.Path:
+    return xdg.xdg_cache_home() / 'ryba'
+
+
+def load_bytes(name: str) -> t.Optional[bytes]:
+    """
+    Load a cache file. If the cache file does not exist or can not be
+    read, `None` is returned. Caches are only ever hints, so a broken cache
+    should never stop a backup.
+    """
+    try:
+        return (get_default_cache_path() / name).read_bytes()
+    except OSError:
+        return None
+
+
+def store_bytes(name: str, data: bytes) -> None:
+    """
+    Write a cache file. The file is replaced atomically,
+    so concurrent readers see either the old or the new contents.
+    """
+    path = get_default_cache_path() / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_name)
+        raise
+
+
+def load_json(name: str) -> t.Any:
+    """
+    Load a JSON cache file. If the cache file does not exist or can not be
+    read, `None` is returned.
+    """
+    data = load_bytes(name)
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def store_json(name: str, data: t.Any) -> None:
+    """Write a JSON cache file, replacing it atomically."""
+    store_bytes(name, json.dumps(data).encode())
+
+
+def has_marker(name: str) -> bool:
+    """Check whether a marker file exists in the cache."""
+    return (get_default_cache_path() / name).exists()
+
+
+def set_marker(name: str) -> None:
+    """
+    Create an empty marker file in the cache,
+    to remember that something is true between runs.
+    """
+    path = get_default_cache_path() / name
+    with contextlib.suppress(OSError):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+
+
+def clear_marker(name: str) -> None:
+    """Remove a marker file from the cache, if it exists."""
+    with contextlib.suppress(OSError):
+        (get_default_cache_path() / name).unlink()
@@ -2,6 +2,7 @@
 Backup local files to remotes using rsync.
 """
 import argparse
+import asyncio
 import contextlib
 import datetime
 import pathlib
@@ -101,6 +102,15 @@ def _get_argparse_parser() -> argparse.ArgumentParser:
         type=_parse_datetime,
         default=_utc_now(),
     )
+    backup.add_argument(
+        "-j", "--jobs", dest="jobs",
+        help=(
+            "How many targets to back up to at the same time. "
+            "Directories on the same target are always backed up one after another. "
+            "Defaults to the 'jobs' option in the config, or 1."
+        ),
+        type=int,
+    )
     backup.set_defaults(func=cmd_backup)
 
     test_rotator = subparsers.add_parser(
@@ -160,9 +170,12 @@ def _get_matching_directories(
 
 
 def cmd_default(config: config.Config, arguments: argparse.Namespace) -> None:
-    timestamp = _utc_now()
-    for directory in directories.Directory.all_from_config(config):
-        backup.backup_directory(directory, config=config, timestamp=timestamp)
+    asyncio.run(backup.backup_directories_async(
+        directories.Directory.all_from_config(config),
+        config=config,
+        timestamp=_utc_now(),
+        concurrency=config['ryba']['jobs'],
+    ))
 
 
 def cmd_backup(config: config.Config, arguments: argparse.Namespace) -> None:
@@ -172,12 +185,13 @@ def cmd_backup(config: config.Config, arguments: argparse.Namespace) -> None:
         directories_to_backup = _get_matching_directories(
             directories_to_backup, [p.expanduser() for p in arguments.directories])
 
-    for directory in directories_to_backup:
-        backup.backup_directory(
-            directory, config=config,
-            dry_run=arguments.dry_run,
-            timestamp=arguments.timestamp,
-        )
+    jobs = arguments.jobs if arguments.jobs is not None else config['ryba']['jobs']
+    asyncio.run(backup.backup_directories_async(
+        directories_to_backup, config=config,
+        dry_run=arguments.dry_run,
+        timestamp=arguments.timestamp,
+        concurrency=jobs,
+    ))
 
 
 def cmd_test_rotator(config: config.Config, arguments: argparse.Namespace) -> None:
@@ -203,8 +217,7 @@ def cmd_test_rotator(config: config.Config, arguments: argparse.Namespace) -> No
         logger.log(logging.MESSAGE, f"Not rotating backups: {reason}")
 
     verdicts = sorted(rotator.rotate_backups(timestamp, list(backups)))
-    for message in map(rotate.format_verdict_tuple, verdicts):
-        logger.log(logging.MESSAGE, message)
+    logger.log(logging.MESSAGE, "Rotation results:\n%s", rotate.format_verdicts(verdicts))
 
 
 # Config helpers
@@ -1,12 +1,265 @@
+import asyncio
+import contextlib
 import datetime
-import shlex
-import subprocess
+import functools
+import hashlib
+import pathlib
+import typing as t
 
-from .. import config, constants, directories, exceptions, logging, targets
+import attr
+
+from .. import (
+    cache, config, constants, directories, exceptions, logging, rsync, scan,
+    targets)
 from . import rotate, snapshot
 
 logger = logging.getLogger(__name__)
 
+#: The rsync flags used for every backup,
+#: inspired by python-rsync-system-backup.
+_RSYNC_BASE_FLAGS = (
+    '--human-readable',
+    # The progress output is always read to measure the throughput,
+    # even if it is not shown.
+    '--info=progress2,stats',
+
+    # The following rsync options delete files in the backup
+    # destination that no longer exist on the local system.
+    # Due to snapshotting this won't cause data loss.
+    '--delete-after',
+    '--delete-excluded',
+
+    # The following rsync options are intended to preserve
+    # as much filesystem metadata as possible.
+    '--acls',
+    '--archive',
+    '--hard-links',
+    # Giving --fuzzy twice is deliberate. The second one makes rsync also look
+    # for similar files to use as a basis in any --link-dest directories.
+    '--fuzzy',
+    '--fuzzy',
+    '--numeric-ids',
+    '--xattrs',
+)
+
+
+def backup_directories(
+    directories_to_backup: t.Iterable[directories.Directory],
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+    max_workers: int = 1,
+) -> None:
+    """
+    Backup many directories, sending files to up to `max_workers` targets at once.
+    See `backup_directories_async` for how the backups are run,
+    and `backup_directory` for the other arguments.
+    """
+    asyncio.run(backup_directories_async(
+        directories_to_backup, config=config, timestamp=timestamp,
+        dry_run=dry_run, concurrency=max_workers))
+
+
+#: A directory passed between the stages of `backup_directories_async`,
+#: along with the context for its target,
+#: and the snapshots dropped by the rotation that are still to be deleted.
+_PipelineItem = t.Tuple[directories.Directory, targets.TargetContext, rotate.Rotation]
+
+
+async def backup_directories_async(
+    directories_to_backup: t.Iterable[directories.Directory],
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+    concurrency: int = 1,
+) -> None:
+    """
+    Backup many directories, sending files to up to `concurrency` targets at once.
+
+    Directories are grouped by their target,
+    and all the directories in a group share a single connection to the target.
+    Each backup passes through three stages, connected by queues:
+    sending the files, creating the snapshot, and deleting the dropped snapshots.
+    This lets the files for one directory be sent
+    while the snapshot for the previous directory is being created,
+    and the snapshots dropped by the one before that are being deleted.
+
+    The directories in a group are sent one after another.
+    Commands for the different stages can run on a target at the same time,
+    as each stage works on a different directory.
+    Dropped snapshots are deleted for one directory at a time.
+    Snapshots left behind by an interrupted backup are deleted
+    for each target before its files are sent.
+
+    See `backup_directory` for the other arguments.
+    """
+    _log_rsync_version()
+    concurrency = max(concurrency, 1)
+    semaphore = asyncio.Semaphore(concurrency)
+    groups = _group_by_target(directories_to_backup)
+    # rsync output from several targets at once would be mixed together,
+    # so each line is labelled with the target it came from
+    label_output = concurrency > 1 and len(groups) > 1
+    snapshot_queue: 'asyncio.Queue[t.Optional[_PipelineItem]]' = asyncio.Queue()
+    rotate_queue: 'asyncio.Queue[t.Optional[_PipelineItem]]' = asyncio.Queue()
+
+    async with contextlib.AsyncExitStack() as stack:
+
+        async def send_target(
+            target: targets.Target, group: t.List[directories.Directory],
+        ) -> None:
+            async with semaphore:
+                context = await stack.enter_async_context(_connect(target))
+                await _make_target_directories(group, context, dry_run=dry_run)
+                await rotate.reap_dropped(group, context, config=config, dry_run=dry_run)
+                for directory in group:
+                    rotation = await send_directory(
+                        directory, context, config=config, timestamp=timestamp, dry_run=dry_run,
+                        output_prefix=target.name if label_output else None)
+                    await snapshot_queue.put((directory, context, rotation))
+            logger.log(logging.INFO, "Finished sending files to %s", target)
+
+        async def send_stage() -> None:
+            await _run_all(*(
+                send_target(target, group) for target, group in groups
+            ))
+            for _ in range(concurrency):
+                await snapshot_queue.put(None)
+
+        async def snapshot_worker() -> None:
+            while (item := await snapshot_queue.get()) is not None:
+                directory, context, rotation = item
+                await snapshot.create_snapshot(
+                    directory, context, timestamp=timestamp, dry_run=dry_run)
+                await rotate_queue.put(item)
+
+        async def snapshot_stage() -> None:
+            await _run_all(*(snapshot_worker() for _ in range(concurrency)))
+            await rotate_queue.put(None)
+
+        async def rotate_stage() -> None:
+            while (item := await rotate_queue.get()) is not None:
+                directory, context, rotation = item
+                await rotate.finalize_rotation(
+                    directory, context, rotation, config=config, dry_run=dry_run)
+                logger.log(logging.INFO, "Finished backing up %s", directory)
+
+        await _run_all(send_stage(), snapshot_stage(), rotate_stage())
+
+
+async def _run_all(*awaitables: t.Awaitable[None]) -> None:
+    """
+    Run a number of coroutines concurrently.
+    If any of them fail, the rest are cancelled before the error is raised.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _run_to_completion(awaitable: t.Awaitable[None]) -> None:
+    """
+    Run a coroutine to completion, even if the caller is cancelled while waiting for it.
+    Cancelling the caller is delayed until the coroutine has finished.
+    """
+    task = asyncio.ensure_future(awaitable)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            cancelled = True
+    task.result()
+    if cancelled:
+        raise asyncio.CancelledError
+
+
+def _log_rsync_version() -> None:
+    """
+    Detect the local rsync version up front, so it is logged once
+    before any backups start.
+    """
+    info = rsync.get_info()
+    if info is not None:
+        logger.log(logging.INFO, "Using rsync %s", info)
+
+
+def _group_by_target(
+    directories_to_backup: t.Iterable[directories.Directory],
+) -> t.List[t.Tuple[targets.Target, t.List[directories.Directory]]]:
+    """
+    Group directories by target, keeping the configured order of directories
+    within each group.
+    """
+    groups: t.Dict[str, t.Tuple[targets.Target, t.List[directories.Directory]]] = {}
+    for directory in directories_to_backup:
+        target = directory.target
+        groups.setdefault(target.name, (target, []))[1].append(directory)
+    return list(groups.values())
+
+
+def backup_target(
+    target: targets.Target,
+    directories_to_backup: t.Sequence[directories.Directory],
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+) -> None:
+    """
+    Backup a number of directories that share a target,
+    one after another using a single connection to the target.
+    The destination directories for all of them are created up front
+    using a single command.
+
+    See `backup_directory` for the other arguments.
+    """
+    backup_directories(
+        [d for d in directories_to_backup if d.target.name == target.name],
+        config=config, timestamp=timestamp, dry_run=dry_run)
+
+
+async def _make_target_directories(
+    directories_to_backup: t.Sequence[directories.Directory],
+    context: targets.TargetContext,
+    *,
+    dry_run: bool,
+) -> None:
+    """
+    Create the destination directories for a number of directories using a single command,
+    skipping those known to exist from a previous backup.
+    """
+    paths = [
+        str(context.make_path(d.target_path)) for d in directories_to_backup
+        if not cache.has_marker(_target_marker(d, context))
+    ]
+    if paths and not dry_run:
+        await asyncio.to_thread(context.execute, ["mkdir", "-p", *paths])
+
+
+@contextlib.asynccontextmanager
+async def _connect(target: targets.Target) -> t.AsyncIterator[targets.TargetContext]:
+    """
+    Connect to a target without blocking the event loop,
+    as connecting to a remote target can take a while.
+    """
+    context = target.connect()
+    await asyncio.to_thread(context.__enter__)
+    try:
+        yield context
+    except BaseException as exc:
+        await asyncio.to_thread(context.__exit__, type(exc), exc, exc.__traceback__)
+        raise
+    else:
+        await asyncio.to_thread(context.__exit__, None, None, None)
+
 
 def backup_directory(
     directory: directories.Directory,
@@ -28,16 +281,18 @@ def backup_directory(
     If `verbose` is True, `rsync` will be run with '-v' flag.
     If `send_files` is True (the default), files will be copied to the backup destination.
     If `create_snapshot` is True (the default), a new timestamped snapshot directory will be create.
+    If `create_snapshot` is False, files are copied in to the current snapshot,
+    updating it in place.
     If `rotate_snapshot` is True (the default), old snapshots will be rotated
     and possibly deleted if they are no longer required.
     """
     with directory.target.connect() as context:
-        backup_directory_with_context(
+        asyncio.run(backup_directory_with_context(
             directory, context, config=config, timestamp=timestamp, dry_run=dry_run,
-            send_files=send_files, create_snapshot=create_snapshot, rotate_snapshot=rotate_snapshot)
+            send_files=send_files, create_snapshot=create_snapshot, rotate_snapshot=rotate_snapshot))
 
 
-def backup_directory_with_context(
+async def backup_directory_with_context(
     directory: directories.Directory,
     context: targets.TargetContext,
     *,
@@ -48,61 +303,174 @@ def backup_directory_with_context(
     create_snapshot: bool = True,
     rotate_snapshot: bool = True,
 ) -> None:
-    logger.log(logging.MESSAGE, "Backing up %s", directory)
-    if send_files:
-        _send_files(
-            directory, context, config=config, dry_run=dry_run)
+    if rotate_snapshot:
+        await rotate.reap_dropped([directory], context, config=config, dry_run=dry_run)
+    rotation = await send_directory(
+        directory, context, config=config, timestamp=timestamp, dry_run=dry_run,
+        send_files=send_files, create_snapshot=create_snapshot, rotate_snapshot=rotate_snapshot)
 
     if create_snapshot:
-        snapshot.create_snapshot(
+        await snapshot.create_snapshot(
             directory, context, dry_run=dry_run, timestamp=timestamp)
 
     if rotate_snapshot:
-        rotate.rotate_directory(
-            directory, context, dry_run=dry_run, timestamp=timestamp)
+        await rotate.finalize_rotation(
+            directory, context, rotation, config=config, dry_run=dry_run)
 
 
-def _send_files(
+async def send_directory(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+    send_files: bool = True,
+    create_snapshot: bool = True,
+    rotate_snapshot: bool = True,
+    output_prefix: t.Optional[str] = None,
+) -> rotate.Rotation:
+    """
+    The first stage of backing up a directory.
+    Snapshots dropped by the rotation are renamed, the new snapshot is prepared,
+    and then the files are sent to the target.
+    The snapshot still has to be created, and the dropped snapshots deleted.
+    If the backup fails, the dropped snapshots are restored.
+
+    Returns the snapshots dropped by the rotation that are still to be deleted,
+    to be passed to `rotate.finalize_rotation`.
+    If `output_prefix` is given, each line of rsync output is labelled with it.
+
+    See `backup_directory` for the other arguments.
+    """
+    logger.log(logging.MESSAGE, "Backing up %s", directory)
+    # This can fail, so is done before anything on the target is changed
+    exclude_from = directory.resolve_exclude_from() if send_files else None
+
+    # Snapshots dropped by the rotation are only renamed before the backup,
+    # and are deleted once the new snapshot has been made.
+    rotation = rotate.Rotation()
+    if rotate_snapshot:
+        rotation = await rotate.prepare_rotation(
+            directory, context, dry_run=dry_run, timestamp=timestamp,
+            pending_snapshot=create_snapshot)
+
+    # Dry runs compare against the current snapshot, as nothing is created.
+    destination = constants.CURRENT_SNAPSHOT_NAME
+    if create_snapshot and not dry_run:
+        destination = directory.snapshot_name(timestamp)
+    seed = None
+
+    try:
+        # With `fast_scan`, only the files that have changed since the scan
+        # made for the current snapshot are sent.
+        # Everything is sent if that scan is not known.
+        current_timestamp = None
+        previous_scan = None
+        if send_files and directory.fast_scan:
+            current_timestamp = await snapshot.current_timestamp(directory, context)
+        if current_timestamp is not None:
+            previous_scan = await asyncio.to_thread(
+                _load_scan_state, directory, context, current_timestamp)
+
+        # Files are sent straight in to the new snapshot,
+        # with unchanged files hard linked from the current snapshot.
+        # The newest dropped snapshot is reused for this if there is one,
+        # as it is likely to be the most similar to the files being sent.
+        # Only sending the changed files needs a full copy of the current snapshot instead,
+        # as does not sending any files at all.
+        link_dest = None
+        if destination != constants.CURRENT_SNAPSHOT_NAME:
+            copy_current = previous_scan is not None or not send_files
+            if rotation.dropped and not copy_current:
+                seed = rotation.dropped[-1]
+            link_dest = await snapshot.prepare_snapshot(
+                directory, context, dry_run=dry_run, timestamp=timestamp,
+                seed=seed, copy_current=copy_current,
+                workers=config['ryba']['remote_workers'])
+
+        # The target directory is known to exist if a previous backup to it worked
+        marker = _target_marker(directory, context)
+        if (
+            send_files and not cache.has_marker(marker)
+            and not await asyncio.to_thread(context.exists, directory.target_path)
+        ):
+            logger.log(logging.INFO, "Creating destination directory %r", directory.target_path)
+            if not dry_run:
+                cmd = ["mkdir", "-p", str(context.make_path(directory.target_path))]
+                await asyncio.to_thread(context.execute, cmd)
+
+        if send_files:
+            # The source is scanned even if everything is sent,
+            # so the next backup has a scan to compare against
+            changes = None
+            if directory.fast_scan:
+                changes = await asyncio.to_thread(
+                    scan.find_changes, directory.source_path, previous_scan,
+                    one_file_system=directory.one_file_system)
+            await _send_files(
+                directory, context, config=config, dry_run=dry_run,
+                destination=destination, link_dest=link_dest, exclude_from=exclude_from,
+                changes=changes if previous_scan is not None else None,
+                output_prefix=output_prefix)
+            snapshot_timestamp = current_timestamp
+            if destination != constants.CURRENT_SNAPSHOT_NAME:
+                snapshot_timestamp = timestamp
+            if changes is not None and snapshot_timestamp is not None and not dry_run:
+                await asyncio.to_thread(
+                    scan.store_state, _scan_state_cache(directory, context),
+                    snapshot_timestamp, changes.state)
+    except BaseException:
+        # However the backup failed, even if it was cancelled, the unfinished
+        # snapshot is discarded and the dropped snapshots are restored.
+        # The seed has been partly updated by rsync, so it can not be restored.
+        to_restore = [name for name in rotation.dropped if name != seed]
+
+        async def abandon() -> None:
+            if destination != constants.CURRENT_SNAPSHOT_NAME:
+                await snapshot.discard_snapshot(directory, context, timestamp=timestamp)
+            await rotate.restore_dropped(directory, context, to_restore)
+
+        await _run_to_completion(abandon())
+        raise
+
+    # The seed is now the new snapshot, so is no longer to be deleted
+    return attr.evolve(rotation, dropped=[name for name in rotation.dropped if name != seed])
+
+
+async def _send_files(
     directory: directories.Directory,
     context: targets.TargetContext,
     *,
     config: config.Config,
     dry_run: bool,
+    destination: str = constants.CURRENT_SNAPSHOT_NAME,
+    link_dest: t.Optional[pathlib.Path] = None,
+    exclude_from: t.Optional[pathlib.Path] = None,
+    changes: t.Optional[scan.Changes] = None,
+    output_prefix: t.Optional[str] = None,
 ) -> None:
-    """Copy files from the source to the target using rsync."""
-    # The following flags are inspired by python-rsync-system-backup
-    command = ['rsync']
-
-    command.append('--human-readable')
+    """
+    Copy files from the source to the target using rsync.
+    `destination` is the name of the snapshot directory to copy the files in to.
+    Files that are unchanged from the snapshot at `link_dest`, if given,
+    are hard linked from there instead of being copied.
+    `exclude_from` is the resolved `Directory.exclude_from` file, if there is one.
+    If `changes` is given, only the paths in it are sent,
+    and `destination` must already hold a copy of everything else.
+    `output_prefix` is passed to `rsync.echo_and_measure`.
+    """
     verbosity = config.get(logging.Verbosity)
-    if verbosity is logging.Verbosity.all:
-        # Turn on fairly verbose logging for rsync
-        command.append('--verbose')
-    elif verbosity is logging.Verbosity.silent:
-        # rsync is silent by default
-        pass
-    else:
-        # Some minimal rsync output
-        command.append('--info=progress2,stats')
-
-    if dry_run:
-        command.append('--dry-run')
+    command = list(_rsync_base_command(verbosity, dry_run, config['rsync']['old_args']))
 
-    # The following rsync options delete files in the backup
-    # destination that no longer exist on the local system.
-    # Due to snapshotting this won't cause data loss.
-    command.append('--delete-after')
-    command.append('--delete-excluded')
+    # The following rsync options pick how much to compress
+    # based on how fast the last transfer to this target was.
+    command.extend(rsync.tuning_arguments(rsync.load_throughput(directory.target.name)))
 
-    # The following rsync options are intended to preserve
-    # as much filesystem metadata as possible.
-    command.append('--acls')
-    command.append('--archive')
-    command.append('--hard-links')
-    command.append('--fuzzy')
-    command.append('--fuzzy')
-    command.append('--numeric-ids')
-    command.append('--xattrs')
+    # The following rsync option makes a snapshot by hard linking
+    # unchanged files from the previous snapshot.
+    if link_dest is not None:
+        command.append(f'--link-dest={link_dest}')
 
     # The following rsync option avoids including mounted external
     # drives like USB sticks in system backups.
@@ -110,50 +478,154 @@ def _send_files(
         command.append('--one-file-system')
 
     # The following rsync options allow user defined exclusion.
-    if (exclude_from := directory.resolve_exclude_from()) is not None:
-        command.append('--exclude-from=%s' % exclude_from)
-    for pattern in directory.exclude_files:
-        command.append('--exclude=%s' % pattern)
+    if exclude_from is not None:
+        command.append(f'--exclude-from={exclude_from}')
+    command.extend(f'--exclude={pattern}' for pattern in directory.exclude_files)
 
-    current_path = context.make_path(directory.target_path / constants.CURRENT_SNAPSHOT_NAME)
-    target_str, target_arguments = directory.target.rsync_arguments(current_path)
+    # The following rsync options send a list of the changed paths,
+    # found by scanning the source here, instead of rsync scanning
+    # and comparing every file itself.
+    # Without `--recursive`, a changed directory listed as `dir/.` is sent
+    # along with the entries directly in it, deleting any that are gone.
+    files_from = None
+    if changes is not None:
+        files_from = await asyncio.to_thread(scan.write_files_from, changes.paths)
+        command.extend([
+            f'--files-from={files_from}', '--from0', '--dirs', '--delete-missing-args'])
+
+    destination_path = context.make_path(directory.target_path / destination)
+    target_str, target_arguments = directory.target.rsync_arguments(destination_path)
 
     command.extend(target_arguments)
-    command.append(_ensure_trailing_slash(str(directory.source_path)))
-    command.append(_ensure_trailing_slash(target_str))
+    # Trailing slashes make rsync copy the contents of the source directory
+    # in to the destination directory, rather than the directory itself.
+    source_str = str(directory.source_path)
+    command.append(source_str if source_str.endswith('/') else source_str + '/')
+    command.append(target_str if target_str.endswith('/') else target_str + '/')
 
-    if not context.exists(directory.target_path):
-        logger.log(logging.INFO, "Creating destination directory %r", directory.target_path)
-        if not dry_run:
-            cmd = ["mkdir", "-p", str(context.make_path(directory.target_path))]
-            context.execute(cmd)
+    marker = _target_marker(directory, context)
 
     logger.log(logging.INFO, "Running rsync")
-    logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+    logger.log(logging.DEBUG, logging.command(command))
 
-    # Execute the rsync command.
-    result = subprocess.run(command, check=False)
+    # Execute the rsync command, reading its output to measure the throughput.
+    # stderr is left alone so errors are always shown.
+    # File descriptors are not inheritable by default since Python 3.4,
+    # so nothing leaks in to rsync with close_fds=False,
+    # and it lets subprocess use posix_spawn instead of fork and exec.
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, env=context.env, close_fds=False)
+        assert process.stdout is not None
+        try:
+            throughput = await rsync.echo_and_measure(
+                process.stdout, echo=verbosity is not logging.Verbosity.silent,
+                prefix=output_prefix)
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            # Stop rsync if the backup is cancelled, for example because
+            # a concurrent backup failed
+            process.terminate()
+            await process.wait()
+            raise
+    finally:
+        if files_from is not None:
+            files_from.unlink(missing_ok=True)
 
     # From `man rsync':
     #  - 23: Partial transfer due to error.
     #  - 24: Partial transfer due to vanished source files.
     # This can be expected on a running system
     # without proper filesystem snapshots :-).
-    if result.returncode in (0, 23, 24):
+    if returncode in (0, 23, 24):
         logger.log(logging.INFO, "Finished backup")
-        if result.returncode != 0:
+        if not dry_run:
+            cache.set_marker(marker)
+            if throughput is not None:
+                rsync.store_throughput(directory.target.name, throughput)
+        if returncode != 0:
             logger.log(
                 logging.WARNING,
                 "Ignoring `partial transfer' warnings (rsync exited with %i).",
-                result.returncode,
+                returncode,
             )
     else:
-        logger.log(logging.ERROR, "Backup failed! (rsync exited with %i)", result.returncode)
-        raise exceptions.RsyncError("rsync call failed", result.returncode)
+        logger.log(logging.ERROR, "Backup failed! (rsync exited with %i)", returncode)
+        cache.clear_marker(marker)
+        raise exceptions.RsyncError("rsync call failed", returncode)
+
+
+@functools.cache
+def _rsync_base_command(
+    verbosity: logging.Verbosity,
+    dry_run: bool,
+    old_args: t.Union[bool, str],
+) -> t.Tuple[str, ...]:
+    """
+    The start of the rsync command, which is the same for every directory.
+    This is only built once for each combination of options.
+    """
+    command = [rsync.executable(), *_RSYNC_BASE_FLAGS]
+
+    if verbosity is logging.Verbosity.all:
+        # Turn on fairly verbose logging for rsync
+        command.append('--verbose')
+
+    if dry_run:
+        command.append('--dry-run')
+
+    # The following rsync option controls how arguments such as
+    # exclude patterns are passed to the remote rsync.
+    command.extend(rsync.old_args_arguments(old_args))
+
+    return tuple(command)
+
+
+def _load_scan_state(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    timestamp: datetime.datetime,
+) -> t.Optional[scan.ScanState]:
+    """
+    Load the scan made for the snapshot made at `timestamp`,
+    to find what has changed in the source directory since.
+    """
+    state = scan.load_state(_scan_state_cache(directory, context), timestamp)
+    if state is None:
+        logger.log(
+            logging.INFO, "The scan for the last backup is not known, sending everything")
+    return state
+
+
+def _cache_name(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+) -> str:
+    """
+    The start of the names of cache files about the target directory for this Directory.
+    """
+    target_path = str(context.make_path(directory.target_path))
+    path_hash = hashlib.sha256(target_path.encode()).hexdigest()
+    return f"{directory.target.name}/{path_hash}"
 
 
-def _ensure_trailing_slash(path: str) -> str:
-    """Ensure a path ends with a slash."""
-    if not path.endswith('/'):
-        return path + '/'
-    return path
+def _target_marker(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+) -> str:
+    """
+    The name of the cache marker recording that
+    the target directory for this Directory exists.
+    """
+    return f"{_cache_name(directory, context)}.exists"
+
+
+def _scan_state_cache(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+) -> str:
+    """
+    The name of the cache file holding the scan made
+    by the last backup of this Directory that used `fast_scan`.
+    """
+    return f"{_cache_name(directory, context)}.dirs"
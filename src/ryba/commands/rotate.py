@@ -1,63 +1,358 @@
+import asyncio
 import datetime
+import json
+import pathlib
+import shlex
 import typing as t
 
-from .. import directories, logging, rotators, targets
+import attr
+import iso8601
+
+from .. import (
+    config, constants, directories, exceptions, logging, rotators, targets)
+from . import snapshot
 
 logger = logging.getLogger(__name__)
 
 TBackupVerdict = t.Tuple[targets.Backup, rotators.Verdict, str]
 
 
-def rotate_directory(
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Rotation:
+    """The outcome of `prepare_rotation`."""
+
+    #: The new names of the dropped snapshots that have been renamed
+    dropped: t.List[str] = attr.ib(factory=list)
+
+    #: The name of the dropped snapshot that the current snapshot points to.
+    #: This is only renamed by `finalize_rotation`, once the new snapshot replaces it.
+    replaced: t.Optional[str] = None
+
+
+async def rotate_directory(
     directory: directories.Directory,
     context: targets.TargetContext,
     *,
+    config: config.Config,
     timestamp: datetime.datetime,
     dry_run: bool = False,
 ) -> None:
     """
     Rotate the existing snapshots for this directory,
     using the configured rotator for the directory.
+    Dropped snapshots are deleted straight away.
+    """
+    # If this is a dry run, a current snapshot will not have been made.
+    # To simulate the backup process properly, add a fictitious snapshot
+    # that would have been created in a normal run
+    await reap_dropped([directory], context, config=config, dry_run=dry_run)
+    rotation = await prepare_rotation(
+        directory, context, timestamp=timestamp, dry_run=dry_run,
+        pending_snapshot=dry_run)
+    await finalize_rotation(directory, context, rotation, config=config, dry_run=dry_run)
+
+
+async def prepare_rotation(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+    pending_snapshot: bool = False,
+) -> Rotation:
+    """
+    Decide which snapshots to drop using the configured rotator for the directory,
+    and rename the dropped snapshots with a `.deleting` suffix.
+    Renaming is quick no matter how large a snapshot is,
+    so this can happen before the backup without holding it up.
+    The renamed snapshots are deleted by `finalize_rotation`.
+
+    If `pending_snapshot` is True, a snapshot for `timestamp` is about to be created,
+    and is included when deciding which snapshots to keep.
+
+    The snapshot that the current snapshot points to is never renamed here.
+    If it is dropped in favour of the pending snapshot, it is deleted by `finalize_rotation`
+    once the new snapshot has been created. Otherwise it is kept.
     """
     if directory.rotate is None:
         logger.log(logging.INFO, "Not rotating backups: no rotator configured")
-        return
+        return Rotation()
 
     if (reason := directory.rotate.should_rotate()) is not True:
         logger.log(logging.INFO, f"Not rotating backups: {reason}")
-        return
+        return Rotation()
+
+    last_rotation = await _read_last_rotation(directory, context)
+    if not directory.rotate.cheap_precheck(last_rotation, timestamp):
+        assert last_rotation is not None
+        logger.log(
+            logging.INFO, "Not rotating backups: already rotated at %s",
+            last_rotation.isoformat())
+        return Rotation()
 
     logger.log(logging.INFO, f"Rotating backups using '{directory.rotate}' strategy")
-    backups = list(context.list_backups(directory.target_path))
+    target_exists = await asyncio.to_thread(context.exists, directory.target_path)
+    if target_exists:
+        backups = await asyncio.to_thread(
+            lambda: list(context.list_backups(directory.target_path)))
+    else:
+        backups = []
 
-    # If this is a dry run, a current snapshot will not have been made.
-    # To simulate the backup process properly, append a fictitious snapshot
-    # that would have been created in a normal run
-    if dry_run and timestamp is not None:
-        backups.append(targets.Backup(
-            name=directory.snapshot_name(timestamp),
-            timestamp=timestamp))
+    # The current snapshot is found by its timestamp, as it is a link to one of the backups
+    current_timestamp = None
+    if backups:
+        current_timestamp = await snapshot.current_timestamp(directory, context)
+    current_name = next(
+        (backup.name for backup in backups if backup.timestamp == current_timestamp), None)
+    pending_name = None
+    if pending_snapshot:
+        pending_name = directory.snapshot_name(timestamp)
+        backups.append(targets.Backup(name=pending_name, timestamp=timestamp))
+
+    if not backups:
+        return Rotation()
 
     verdicts = sorted(directory.rotate.rotate_backups(timestamp, backups))
-    for message in map(format_verdict_tuple, verdicts):
-        logger.log(logging.INFO, message)
-    if not dry_run:
-        delete_snapshots(directory, context, verdicts)
+    logger.log(logging.INFO, "Rotation results:\n%s", format_verdicts(verdicts))
+
+    to_drop = [
+        backup.name for backup, verdict, explanation in verdicts
+        if verdict is rotators.Verdict.drop and backup.name != pending_name
+    ]
+    replaced = None
+    if current_name in to_drop:
+        if pending_snapshot:
+            replaced = current_name
+        else:
+            logger.log(
+                logging.INFO, "Keeping %s, as it is the current snapshot", current_name)
+    to_rename = [name for name in to_drop if name != current_name]
+    if dry_run:
+        return Rotation()
+
+    renames = [
+        (
+            context.make_path(directory.target_path / name),
+            context.make_path(directory.target_path / (name + constants.DELETING_SUFFIX)),
+        )
+        for name in to_rename
+    ]
+    if renames:
+        script = " && ".join(
+            shlex.join(["mv", "--no-target-directory", str(old), str(new)])
+            for old, new in renames
+        )
+        await asyncio.to_thread(context.execute, ["sh", "-c", script])
+    if target_exists:
+        await _write_last_rotation(directory, context, timestamp)
+    return Rotation(dropped=[new.name for old, new in renames], replaced=replaced)
+
+
+async def restore_dropped(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    dropped: t.Sequence[str],
+) -> None:
+    """
+    Undo the renames made by `prepare_rotation`, for when a backup fails.
+    These snapshots were only dropped to make room for the snapshot
+    that was never made, so they should be kept.
+    """
+    renames = [
+        (
+            context.make_path(directory.target_path / name),
+            context.make_path(directory.target_path / name[:-len(constants.DELETING_SUFFIX)]),
+        )
+        for name in dropped
+    ]
+    if renames:
+        logger.log(logging.INFO, "Restoring %d dropped snapshots", len(renames))
+        script = " && ".join(
+            shlex.join(["mv", "--no-target-directory", str(old), str(new)])
+            for old, new in renames
+        )
+        await asyncio.to_thread(context.execute, ["sh", "-c", script])
+
+
+async def _read_last_rotation(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+) -> t.Optional[datetime.datetime]:
+    """
+    Find when the backups for this directory were last rotated,
+    from the state file in the target directory.
+    """
+    try:
+        content = await asyncio.to_thread(
+            context.read_file, directory.target_path / constants.STATE_FILE_NAME)
+        return iso8601.parse_date(json.loads(content)['last_rotation'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
 
+async def _write_last_rotation(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    timestamp: datetime.datetime,
+) -> None:
+    """Record when the backups for this directory were last rotated."""
+    content = json.dumps({'last_rotation': timestamp.isoformat()})
+    await asyncio.to_thread(
+        context.write_file,
+        directory.target_path / constants.STATE_FILE_NAME,
+        content.encode())
+
+
+async def finalize_rotation(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    rotation: Rotation,
+    *,
+    config: config.Config,
+    dry_run: bool = False,
+) -> None:
+    """
+    Delete the snapshots renamed by `prepare_rotation`,
+    along with the replaced snapshot if one was dropped.
+    Nothing is run on the target if nothing was dropped.
+    """
+    if dry_run or not (rotation.dropped or rotation.replaced):
+        return
+
+    dropped = list(rotation.dropped)
+    if rotation.replaced is not None:
+        # Renamed first, so that it is cleaned up by `reap_dropped`
+        # if deleting it is interrupted
+        old = context.make_path(directory.target_path / rotation.replaced)
+        dropped.append(rotation.replaced + constants.DELETING_SUFFIX)
+        new = context.make_path(directory.target_path / dropped[-1])
+        cmd = ["mv", "--no-target-directory", str(old), str(new)]
+        await asyncio.to_thread(context.execute, cmd)
+
+    paths = [context.make_path(directory.target_path / name) for name in sorted(dropped)]
+    logger.log(logging.INFO, "Deleting %d dropped snapshots", len(paths))
+    await _bulk_delete(
+        context, paths,
+        strategy=config['ryba']['delete_strategy'],
+        workers=config['ryba']['remote_workers'])
+
+
+async def reap_dropped(
+    directories_to_reap: t.Sequence[directories.Directory],
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+    dry_run: bool = False,
+) -> None:
+    """
+    Delete any renamed snapshots left behind by an interrupted backup,
+    for a number of directories on the same target using a single command.
+    This only needs to happen once per target in each run,
+    as `finalize_rotation` deletes everything dropped by the run itself.
+    """
+    if dry_run or not directories_to_reap:
+        return
+    logger.log(logging.INFO, "Deleting any dropped snapshots left by earlier backups")
+    find_cmd = shlex.join([
+        "find",
+        *(str(context.make_path(d.target_path)) for d in directories_to_reap),
+        "-mindepth", "1", "-maxdepth", "1", "-name", "*" + constants.DELETING_SUFFIX,
+        "-print0",
+    ])
+    # Target directories that do not exist yet have nothing to delete
+    await _bulk_delete(
+        context, f"{find_cmd} 2>/dev/null",
+        strategy=config['ryba']['delete_strategy'],
+        workers=config['ryba']['remote_workers'])
 
-def format_verdict_tuple(verdict_tuple: TBackupVerdict) -> t.Iterable[str]:
+
+def format_verdict_tuple(verdict_tuple: TBackupVerdict) -> str:
     """Format the verdict tuple for logging."""
     backup, verdict, explanation = verdict_tuple
     return f"  - {backup.name}: {verdict.name}. {explanation}"
 
 
-def delete_snapshots(
-    directory: directories.Directory,
+def format_verdicts(verdicts: t.Sequence[TBackupVerdict]) -> logging.Lazy:
+    """
+    Format all the verdicts for logging as a single multi-line message.
+    The message is only built if it is going to be shown.
+    """
+    return logging.Lazy(lambda: "\n".join(map(format_verdict_tuple, verdicts)))
+
+
+#: Ways of deleting snapshots, for the `delete_strategy` option
+DELETE_STRATEGIES = ['rm', 'rsync']
+
+
+async def _bulk_delete(
     context: targets.TargetContext,
-    verdicts: t.List[TBackupVerdict],
+    paths: t.Union[t.List[pathlib.Path], str],
+    *,
+    strategy: str,
+    workers: int = 1,
 ) -> None:
-    for backup, verdict, explanation in sorted(verdicts):
-        if verdict is rotators.Verdict.drop:
-            entry_path = context.make_path(directory.target_path / backup.name)
-            context.execute(["chmod", "-R", "u+wX", str(entry_path)])
-            context.execute(["rm", "-rf", str(entry_path)])
+    """
+    Delete a number of directories on the target using only a few commands,
+    no matter how many directories there are.
+    Up to `workers` directories are deleted at once using `xargs -P`.
+    `paths` is either a list of directories,
+    or a shell command that prints the directories separated by null bytes.
+
+    With the 'rm' strategy, the directories are removed with `rm -rf`.
+    With the 'rsync' strategy, an empty directory is synced over each directory
+    using `rsync --delete` before removing it.
+    This can be faster than `rm` for directories with very many files.
+    """
+    if strategy not in DELETE_STRATEGIES:
+        raise exceptions.ConfigError(
+            f"Unknown delete strategy {strategy!r}, "
+            f"expected one of {', '.join(map(repr, DELETE_STRATEGIES))}")
+    if not isinstance(workers, int) or workers < 1:
+        raise exceptions.ConfigError(
+            f"Invalid remote_workers {workers!r}, expected a positive number")
+
+    if strategy == 'rm':
+        delete = 'rm -rf "$1"'
+    else:
+        delete = 'rsync --recursive --delete "$empty/" "$1/" && rmdir "$1"'
+    # Snapshots can contain read only directories,
+    # which would stop their contents being deleted.
+    # These are only made writable if deleting a snapshot fails,
+    # to save walking over every snapshot twice.
+    delete_one = shlex.quote(f'{{ {delete}; }} 2>/dev/null || {{ chmod -R u+wX "$1" && {delete}; }}')
+
+    if isinstance(paths, str):
+        listing = paths
+        quoted_paths = None
+    else:
+        quoted_paths = ' '.join(shlex.quote(str(path)) for path in paths)
+        listing = f"printf '%s\\0' {quoted_paths}"
+    xargs = f"xargs -0 -r -P{workers} -n1 sh -c {delete_one} sh"
+
+    if strategy == 'rm' and workers == 1 and quoted_paths is not None:
+        script = (
+            f"rm -rf {quoted_paths} 2>/dev/null"
+            f" || {{ chmod -R u+wX {quoted_paths} 2>/dev/null; rm -rf {quoted_paths}; }}")
+    elif strategy == 'rm':
+        script = f"{listing} | {xargs}"
+    elif workers == 1 and quoted_paths is not None:
+        script = "\n".join([
+            'empty=$(mktemp -d) || exit 1',
+            'export empty',
+            'status=0',
+            f'for path in {quoted_paths}; do',
+            f'    sh -c {delete_one} sh "$path" || status=1',
+            'done',
+            'rmdir "$empty"',
+            'exit $status',
+        ])
+    else:
+        script = "\n".join([
+            'empty=$(mktemp -d) || exit 1',
+            'export empty',
+            f"{listing} | {xargs}",
+            'status=$?',
+            'rmdir "$empty"',
+            'exit $status',
+        ])
+    await asyncio.to_thread(context.execute, ["sh", "-c", script])
@@ -1,11 +1,125 @@
+import asyncio
 import datetime
+import pathlib
+import shlex
+import typing as t
+
+import iso8601
 
 from .. import constants, directories, logging, targets
 
 logger = logging.getLogger(__name__)
 
 
-def create_snapshot(
+async def prepare_snapshot(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    timestamp: datetime.datetime,
+    seed: t.Optional[str] = None,
+    copy_current: bool = False,
+    workers: int = 1,
+    dry_run: bool,
+) -> t.Optional[pathlib.Path]:
+    """
+    Prepare the directory for a new snapshot of this Directory,
+    which the files are then sent in to.
+
+    If `copy_current` is True, the current snapshot is copied in to place
+    using hard links, so the new snapshot starts out as a full copy of it.
+    This is needed when rsync is only sent the files that have changed.
+    Up to `workers` entries at the top of the current snapshot are copied at once.
+    Otherwise if `seed` is given, it names a dropped snapshot waiting to be deleted,
+    which is moved in to place to be reused.
+    This is quick no matter how large the snapshot is,
+    and rsync only has to update whatever has changed since.
+    Otherwise the directory is left for rsync to create.
+
+    Returns the path to the current snapshot if rsync should
+    hard link unchanged files from it using `--link-dest`.
+    """
+    target_directory = directory.target_path
+    snapshot = context.make_path(target_directory / directory.snapshot_name(timestamp))
+    current = target_directory / constants.CURRENT_SNAPSHOT_NAME
+
+    if copy_current:
+        logger.log(logging.INFO, "Copying current snapshot")
+        source = str(context.make_path(current))
+        rm_cmd = ["rm", "-f", str(snapshot / constants.TIMESTAMP_FILE_NAME)]
+        if workers > 1:
+            script = _parallel_copy_script(source, str(snapshot), workers)
+        else:
+            script = shlex.join([
+                "cp", "--archive", "--link", "--no-target-directory", source + "/", str(snapshot),
+            ])
+        if not dry_run:
+            await asyncio.to_thread(context.execute, ["sh", "-c", f"{script} && {shlex.join(rm_cmd)}"])
+        return None
+
+    if seed is not None:
+        logger.log(logging.INFO, "Reusing dropped snapshot %s", seed)
+        mv_cmd = [
+            "mv", "--no-target-directory",
+            str(context.make_path(target_directory / seed)), str(snapshot),
+        ]
+        # The timestamp file is hard linked with the older snapshot.
+        # Remove it so that the older timestamp is not overwritten,
+        # and so that this snapshot is not considered complete until it has been created.
+        rm_cmd = ["rm", "-f", str(snapshot / constants.TIMESTAMP_FILE_NAME)]
+        if not dry_run:
+            await asyncio.to_thread(
+                context.execute, ["sh", "-c", f"{shlex.join(mv_cmd)} && {shlex.join(rm_cmd)}"])
+
+    if await asyncio.to_thread(context.exists, current):
+        return context.make_path(current)
+    return None
+
+
+def _parallel_copy_script(source: str, destination: str, workers: int) -> str:
+    """
+    Make a shell script that hard link copies `source` to `destination`,
+    copying up to `workers` of the entries directly in `source` at the same time.
+    The timestamp file is left behind, as it belongs to the snapshot being copied.
+    The attributes of `source` itself are copied once everything is in place,
+    as adding the entries changes the modification time.
+    """
+    find_cmd = shlex.join([
+        "find", ".", "-mindepth", "1", "-maxdepth", "1",
+        "!", "-name", constants.TIMESTAMP_FILE_NAME, "-print0",
+    ])
+    xargs_cmd = shlex.join([
+        "xargs", "-0", "-r", "-P", str(workers), "-I{}",
+        "cp", "--archive", "--link", "--no-target-directory", "--", "{}", destination + "/{}",
+    ])
+    return " && ".join([
+        shlex.join(["mkdir", destination]),
+        f"( cd {shlex.quote(source)} && {find_cmd} | {xargs_cmd} )",
+        shlex.join(["chown", f"--reference={source}", destination]),
+        shlex.join(["chmod", f"--reference={source}", destination]),
+        shlex.join(["touch", f"--reference={source}", destination]),
+    ])
+
+
+async def current_timestamp(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+) -> t.Optional[datetime.datetime]:
+    """
+    Find when the current snapshot of this Directory was made,
+    or None if there is no current snapshot.
+    """
+    timestamp_file = (
+        directory.target_path / constants.CURRENT_SNAPSHOT_NAME / constants.TIMESTAMP_FILE_NAME)
+    if not await asyncio.to_thread(context.exists, timestamp_file):
+        return None
+    content = await asyncio.to_thread(context.read_file, timestamp_file)
+    try:
+        return iso8601.parse_date(content.decode())
+    except ValueError:
+        return None
+
+
+async def create_snapshot(
     directory: directories.Directory,
     context: targets.TargetContext,
     *,
@@ -13,20 +127,47 @@ def create_snapshot(
     dry_run: bool,
 ) -> None:
     """
-    Create a snapshot of the current backup for this Directory.
+    Create a snapshot of the current backup for this Directory,
+    from the directory made by `prepare_snapshot`.
+    The snapshot is timestamped, and the `current` link is pointed at it.
     """
     target_directory = directory.target_path
     snapshot_name = directory.snapshot_name(timestamp)
-    current = target_directory / constants.CURRENT_SNAPSHOT_NAME
     snapshot = target_directory / snapshot_name
     logger.log(logging.INFO, "Creating snapshot %s", snapshot_name)
 
-    cmd = [
-        "cp", "--archive", "--link", "--no-target-directory", "--force",
-        str(context.make_path(current)), str(context.make_path(snapshot)),
-    ]
+    current = str(context.make_path(target_directory / constants.CURRENT_SNAPSHOT_NAME))
+    new_current = current + '.new'
+    # Older versions of ryba kept a full copy of the backup in `current`.
+    # This is moved out of the way, to be deleted by `rotate.reap_dropped` on the next backup.
+    script = "\n".join([
+        f"if [ -d {shlex.quote(current)} ] && [ ! -L {shlex.quote(current)} ]; then",
+        "    " + shlex.join(["mv", "--no-target-directory", current, current + constants.DELETING_SUFFIX]),
+        "fi",
+        shlex.join(["ln", "--symbolic", "--force", "--no-dereference", snapshot_name, new_current]),
+        shlex.join(["mv", "--no-target-directory", new_current, current]),
+    ])
     if not dry_run:
-        context.execute(cmd)
-        context.write_file(
+        await asyncio.to_thread(
+            context.write_file,
             snapshot / constants.TIMESTAMP_FILE_NAME,
             timestamp.isoformat().encode())
+        await asyncio.to_thread(context.execute, ["sh", "-c", script])
+
+
+async def discard_snapshot(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    timestamp: datetime.datetime,
+) -> None:
+    """
+    Mark an unfinished snapshot, such as one from a failed backup, to be deleted.
+    """
+    snapshot = str(context.make_path(directory.target_path / directory.snapshot_name(timestamp)))
+    script = "\n".join([
+        f"if [ -e {shlex.quote(snapshot)} ]; then",
+        "    " + shlex.join(["mv", "--no-target-directory", snapshot, snapshot + constants.DELETING_SUFFIX]),
+        "fi",
+    ])
+    await asyncio.to_thread(context.execute, ["sh", "-c", script])
@@ -32,7 +32,13 @@ class Config:
     DEFAULTS = {
         'ryba': {
             'verbosity': 1,
-        }
+            'jobs': 1,
+            'delete_strategy': 'rm',
+            'remote_workers': 8,
+        },
+        'rsync': {
+            'old_args': 'auto',
+        },
     }
 
     _config: t.Mapping[str, t.Any]
@@ -114,9 +120,9 @@ class NestedChainMap(collections.ChainMap):
             if len(_items) == 0:
                 return prototype
 
-            return NestedChainMap(prototype, *items)
+            return NestedChainMap(prototype, *_items)
 
-        if isinstance(prototype, t.Iterable):
+        if isinstance(prototype, t.Iterable) and not isinstance(prototype, str):
             return list(itertools.chain(prototype, *items))
 
         return prototype  # type: ignore
@@ -1,4 +1,4 @@
-#: The name of the directory to put the current snapshot in.
+#: The name of the link to the current snapshot.
 CURRENT_SNAPSHOT_NAME = 'current'
 
 #: The name of the default `rsync --exclude-from` file
@@ -6,3 +6,9 @@ EXCLUDE_FROM_FILE_NAME = '.rsync-exclude'
 
 #: The name of the timestamp file in a snapshot directory
 TIMESTAMP_FILE_NAME = '.backup-timestamp'
+
+#: The suffix added to dropped snapshots waiting to be deleted
+DELETING_SUFFIX = '.deleting'
+
+#: The name of the file in a target directory that holds ryba's state
+STATE_FILE_NAME = '.ryba-state'
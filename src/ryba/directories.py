@@ -18,6 +18,7 @@ class Directory:
     exclude_files: t.List[str] = attr.ib(factory=list)
 
     one_file_system: bool = True
+    fast_scan: bool = False
 
     @classmethod
     def all_from_config(cls, config: config.Config) -> t.List['Directory']:
@@ -40,7 +40,9 @@ def setup_logging(config: config.Config) -> None:
         "loggers": {
             "ryba": {
                 "handlers": ["console"],
-                "level": logging.DEBUG,
+                # Records below this level are never made,
+                # so `isEnabledFor` can skip building messages that would be thrown away.
+                "level": log_level,
             },
             "paramiko": {
                 "handlers": ["console"],
@@ -60,11 +62,25 @@ def setup_logging(config: config.Config) -> None:
     })
 
 
-def command(command: t.List[str], hostname: t.Optional[str] = None) -> str:
+class Lazy:
+    """
+    A log message that is only built when the record is formatted,
+    so no work is done for messages that are filtered out.
+    """
+    __slots__ = ('function',)
+
+    def __init__(self, function: t.Callable[[], str]):
+        self.function = function
+
+    def __str__(self) -> str:
+        return self.function()
+
+
+def command(command: t.List[str], hostname: t.Optional[str] = None) -> Lazy:
     prefix = '$ '
     if hostname:
         prefix = hostname + prefix
-    return prefix + shlex.join(command)
+    return Lazy(lambda: prefix + shlex.join(command))
 
 
 def style(code: str, message: str) -> str:
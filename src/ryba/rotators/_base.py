@@ -30,6 +30,22 @@ class Rotator(config.Configurable, abc.ABC):
         """
         return True
 
+    def cheap_precheck(
+        self,
+        last_rotation: t.Optional[datetime.datetime],
+        timestamp: datetime.datetime,
+    ) -> bool:
+        """
+        Is it worth rotating backups at `timestamp`, if they were last rotated
+        at `last_rotation`? This is checked before listing the existing backups,
+        which can be slow on remote targets.
+        `last_rotation` is None if the backups have not been rotated before.
+
+        Returning False puts rotation off until a later backup,
+        which will only ever keep backups for longer.
+        """
+        return True
+
     @abc.abstractmethod
     def rotate_backups(
         self, timestamp: datetime.datetime, backups: t.List[targets.Backup]
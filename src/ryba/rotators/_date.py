@@ -106,6 +106,29 @@ class DateBucket(Rotator):
                 explanation = "Not kept by any bucket"
             yield backup_date, verdict, explanation
 
+    def cheap_precheck(
+        self,
+        last_rotation: t.Optional[datetime.datetime],
+        timestamp: datetime.datetime,
+    ) -> bool:
+        """
+        Backups are only bucketed by the time period they were made in,
+        so rotating more than once per period of the smallest bucket
+        does not need to happen.
+        """
+        if last_rotation is None:
+            return True
+
+        for count, grouper in [
+            (self.hour, _hour), (self.day, _day), (self.week, _week),
+            (self.month, _month), (self.year, _year),
+        ]:
+            if count:
+                last = targets.Backup(name='', timestamp=last_rotation)
+                now = targets.Backup(name='', timestamp=timestamp)
+                return grouper(last) != grouper(now)
+        return True
+
     def get_winners(self, backups: t.List[targets.Backup]) -> t.Dict[targets.Backup, t.List[str]]:
         backups = sorted(backups)
         decider = max if self.prefer_newest else min
@@ -0,0 +1,211 @@
+"""
+Find out what the local rsync supports, and tune rsync options
+based on how previous transfers went.
+"""
+import asyncio
+import codecs
+import functools
+import re
+import shutil
+import subprocess
+import sys
+import typing as t
+
+import attr
+
+from . import cache, exceptions, logging
+
+logger = logging.getLogger(__name__)
+
+#: The name of the cache file that holds the measured throughput per target.
+THROUGHPUT_CACHE_NAME = 'throughput.json'
+
+#: Links slower than this many bytes per second get heavy compression
+SLOW_LINK = 5_000_000
+#: Links slower than this many bytes per second get moderate compression
+MEDIUM_LINK = 50_000_000
+#: Links at least this many bytes per second fast get no compression
+FAST_LINK = 500_000_000
+
+#: rsync 3.2.4 started escaping arguments passed to the remote rsync
+NEW_ARGS_VERSION = (3, 2, 4)
+#: rsync 3.2.5 renamed --protect-args to --secluded-args
+SECLUDED_ARGS_VERSION = (3, 2, 5)
+
+_UNITS = {'': 1, 'k': 10 ** 3, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+_RATE_RE = re.compile(r'(\d+(?:\.\d+)?)([kKMGT]?)B/s')
+_LINE_END_RE = re.compile(r'[\r\n]')
+_VERSION_RE = re.compile(r'version\s+(\d+(?:\.\d+)*)')
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class RsyncInfo:
+    version: t.Tuple[int, ...]
+
+    @classmethod
+    def from_version_output(cls, output: str) -> 'RsyncInfo':
+        """Parse the output of `rsync --version`."""
+        match = _VERSION_RE.search(output)
+        if match is None:
+            raise ValueError("Could not find rsync version")
+        return cls(version=tuple(int(bit) for bit in match.group(1).split('.')))
+
+    def __str__(self) -> str:
+        return '.'.join(map(str, self.version))
+
+
+@functools.cache
+def executable() -> str:
+    """
+    Find the full path to the local rsync.
+    subprocess can only start a program using the faster `posix_spawn`
+    when it is given a path rather than a bare command name.
+    """
+    return shutil.which('rsync') or 'rsync'
+
+
+@functools.cache
+def get_info() -> t.Optional[RsyncInfo]:
+    """
+    Find the version of the local rsync.
+    `rsync --version` is only run once per process.
+    """
+    try:
+        result = subprocess.run(
+            [executable(), '--version'], check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        return RsyncInfo.from_version_output(result.stdout)
+    except (OSError, subprocess.CalledProcessError, ValueError) as exc:
+        logger.log(logging.WARNING, "Could not detect rsync version: %s", exc)
+        return None
+
+
+def tuning_arguments(throughput: t.Optional[float]) -> t.List[str]:
+    """
+    Pick compression options for a transfer,
+    given the throughput in bytes per second measured during the last transfer.
+    Slow links get compressed harder, while fast links are not compressed at all
+    as compression would only waste CPU time.
+
+    The compression and checksum algorithms are left for the two rsyncs to negotiate,
+    as only the local rsync is known here and the remote rsync may not support the same ones.
+    """
+    if throughput is None or throughput >= FAST_LINK:
+        return []
+
+    if throughput < SLOW_LINK:
+        level = 9
+    elif throughput < MEDIUM_LINK:
+        level = 3
+    else:
+        level = 1
+    return ['--compress', f'--compress-level={level}']
+
+
+def old_args_arguments(old_args: t.Union[bool, str]) -> t.List[str]:
+    """
+    Pick how arguments are passed to the remote rsync, from the `rsync.old_args` option.
+
+    rsync 3.2.4 started escaping arguments sent to the remote shell.
+    `True` restores the older behaviour with `--old-args`.
+    `"auto"` sends the arguments over the rsync protocol instead with
+    `--secluded-args`, so they are never seen by the remote shell at all.
+    `False` leaves rsync to its default behaviour.
+    Nothing is added for older versions of rsync, which do not escape arguments.
+    """
+    if old_args not in (True, False, 'auto'):
+        raise exceptions.ConfigError(
+            f"Unknown rsync.old_args value {old_args!r}, "
+            "expected true, false or \"auto\"")
+
+    info = get_info()
+    if info is None or info.version < NEW_ARGS_VERSION or old_args is False:
+        return []
+    if old_args is True:
+        return ['--old-args']
+    if info.version < SECLUDED_ARGS_VERSION:
+        return ['--protect-args']
+    return ['--secluded-args']
+
+
+def parse_throughput(line: str) -> t.Optional[float]:
+    """
+    Find the transfer rate in a line of `rsync --info=progress2` output,
+    in bytes per second.
+    """
+    match = _RATE_RE.search(line)
+    if match is None:
+        return None
+    number, unit = match.groups()
+    return float(number) * _UNITS[unit]
+
+
+async def echo_and_measure(
+    stream: asyncio.StreamReader, *, echo: bool = True, prefix: t.Optional[str] = None,
+) -> t.Optional[float]:
+    """
+    Read the output of rsync as it is produced, optionally echoing it to stdout,
+    and return the last non-zero transfer rate reported.
+
+    If `prefix` is given, each line is echoed once it is finished,
+    starting with the prefix, so the output of several rsyncs running at once can be told apart.
+    Only the final state of the progress line is echoed, not every redraw of it.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    throughput = None
+    pending = ''
+    pending_echo = ''
+    while (chunk := await stream.read(4096)):
+        text = decoder.decode(chunk)
+        if echo and prefix is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        elif echo and prefix is not None:
+            *lines, pending_echo = (pending_echo + text).split('\n')
+            _echo_lines(prefix, lines)
+        # rsync redraws the progress line using carriage returns
+        *lines, pending = _LINE_END_RE.split(pending + text)
+        for line in lines:
+            if (rate := parse_throughput(line)):
+                throughput = rate
+    text = decoder.decode(b'', final=True)
+    if echo and prefix is not None:
+        _echo_lines(prefix, [pending_echo + text])
+    if (rate := parse_throughput(pending + text)):
+        throughput = rate
+    return throughput
+
+
+def _echo_lines(prefix: str, lines: t.Iterable[str]) -> None:
+    """
+    Echo finished lines of rsync output with a prefix,
+    keeping only the last redraw of each line.
+    """
+    for line in lines:
+        redraws = [redraw for redraw in line.split('\r') if redraw.strip()]
+        if redraws:
+            sys.stdout.write(f"{prefix}: {redraws[-1]}\n")
+    sys.stdout.flush()
+
+
+def load_throughput(target_name: str) -> t.Optional[float]:
+    """Get the throughput measured on the last transfer to a target."""
+    throughputs = cache.load_json(THROUGHPUT_CACHE_NAME)
+    if not isinstance(throughputs, dict):
+        return None
+    value = throughputs.get(target_name)
+    if isinstance(value, (int, float)):
+        return float(value)
+    return None
+
+
+def store_throughput(target_name: str, throughput: float) -> None:
+    """Remember the throughput measured when transferring to a target."""
+    throughputs = cache.load_json(THROUGHPUT_CACHE_NAME)
+    if not isinstance(throughputs, dict):
+        throughputs = {}
+    throughputs[target_name] = throughput
+    try:
+        cache.store_json(THROUGHPUT_CACHE_NAME, throughputs)
+    except OSError as exc:
+        logger.log(logging.WARNING, "Could not save rsync throughput: %s", exc)
@@ -0,0 +1,179 @@
+"""
+Find the files in a directory that have changed since the last backup,
+so rsync can be told exactly what to send instead of scanning everything itself.
+"""
+import contextlib
+import datetime
+import math
+import os
+import pathlib
+import stat
+import tempfile
+import time
+import typing as t
+
+import attr
+import iso8601
+
+from . import cache, logging
+
+logger = logging.getLogger(__name__)
+
+
+#: Seconds taken off the time a scan started before comparing change times against it.
+#: Some filesystems only store times to the nearest one or two seconds,
+#: and the kernel stamps changes using a clock that can lag slightly behind.
+CLOCK_SLACK = 2.0
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class ScanState:
+    """What a scan by `find_changes` found, for the next scan to compare against."""
+
+    #: The wall clock time the scan started at, as a Unix timestamp
+    started: float
+
+    #: The device and inode number of every directory found,
+    #: by its path relative to the source directory
+    directories: t.Dict[bytes, t.Tuple[int, int]] = attr.ib(factory=dict)
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Changes:
+    #: The paths to send, relative to the source directory.
+    #: Changed directories end with `/.`, so that rsync sends everything in them.
+    paths: t.List[bytes] = attr.ib(factory=list)
+
+    #: The state of the source directory, to compare against on the next scan
+    state: ScanState
+
+
+def find_changes(
+    source_path: pathlib.Path,
+    previous: t.Optional[ScanState],
+    *,
+    one_file_system: bool = True,
+) -> Changes:
+    """
+    Walk `source_path`, finding every entry that has changed since the `previous` scan.
+
+    The inode change time is compared against the time the previous scan started,
+    rather than the modification time,
+    so that files which are moved, renamed, or have their permissions changed are noticed too.
+    Adding, removing, or renaming an entry changes the directory it is in.
+    A changed directory is sent along with every entry directly in it,
+    and rsync deletes anything that has been removed from it.
+    Changed files in unchanged directories are sent on their own.
+
+    A directory that has been moved has to be sent along with everything inside it,
+    as none of that is in the same place in the last backup.
+    A directory is assumed to have been moved unless the previous scan
+    found the same directory, by its device and inode number, at the same path.
+    Without a `previous` scan, every directory is assumed to have been moved.
+
+    Directories that can not be read are included so that rsync can report the error.
+    """
+    root = os.fsencode(source_path)
+    state = ScanState(started=time.time())
+    threshold = -math.inf if previous is None else previous.started - CLOCK_SLACK
+    known_directories = {} if previous is None else previous.directories
+    root_stat = os.lstat(root)
+    changes = Changes(state=state)
+
+    # Directories to walk, with whether everything in them has to be sent
+    pending = [(b'.', root_stat, False)]
+    while pending:
+        relative, directory_stat, moved = pending.pop()
+        identity = (directory_stat.st_dev, directory_stat.st_ino)
+        state.directories[relative] = identity
+        moved = moved or known_directories.get(relative) != identity
+        changed = moved or directory_stat.st_ctime > threshold
+        if changed:
+            changes.paths.append(_contents(relative))
+        try:
+            entries = os.scandir(os.path.join(root, relative))
+        except OSError:
+            if not changed:
+                changes.paths.append(_contents(relative))
+            continue
+        with entries:
+            for entry in entries:
+                path = entry.name if relative == b'.' else os.path.join(relative, entry.name)
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if (
+                    stat.S_ISDIR(entry_stat.st_mode)
+                    and not (one_file_system and entry_stat.st_dev != root_stat.st_dev)
+                ):
+                    pending.append((path, entry_stat, moved))
+                elif not changed and entry_stat.st_ctime > threshold:
+                    changes.paths.append(path)
+
+    if previous is not None:
+        since = datetime.datetime.fromtimestamp(previous.started).astimezone()
+        logger.log(
+            logging.INFO, "Found %d changed paths since %s",
+            len(changes.paths), since.isoformat(timespec='seconds'))
+    return changes
+
+
+def _contents(directory: bytes) -> bytes:
+    """The path that makes rsync send a directory along with every entry in it."""
+    return directory if directory == b'.' else directory + b'/.'
+
+
+def write_files_from(paths: t.Iterable[bytes]) -> pathlib.Path:
+    """
+    Write paths to a temporary file, separated by null bytes,
+    for use with `rsync --files-from --from0`.
+    The caller is responsible for deleting the file.
+    """
+    fd, name = tempfile.mkstemp(prefix='ryba-files-from-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for path in paths:
+                f.write(path + b'\0')
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(name)
+        raise
+    return pathlib.Path(name)
+
+
+def load_state(name: str, timestamp: datetime.datetime) -> t.Optional[ScanState]:
+    """
+    Load the state stored in a cache file by `store_state`.
+    If it was not stored for the snapshot made at `timestamp`,
+    or the cache file can not be read, `None` is returned.
+    The timestamp is only used to match the state to the snapshot,
+    the time the scan started at is stored separately.
+    """
+    data = cache.load_bytes(name)
+    if data is None:
+        return None
+    try:
+        tag, started, *fields = data.split(b'\0')
+        if iso8601.parse_date(tag.decode()) != timestamp:
+            return None
+        state = ScanState(started=float(started))
+        for identity, path in zip(fields[0::2], fields[1::2]):
+            device, inode = identity.split(b':')
+            state.directories[path] = (int(device), int(inode))
+    except ValueError:
+        return None
+    return state
+
+
+def store_state(name: str, timestamp: datetime.datetime, state: ScanState) -> None:
+    """
+    Store the state found by `find_changes` in a cache file,
+    for the snapshot made at `timestamp`.
+    This is only a hint, so failing to store it does not stop the backup.
+    """
+    fields = [timestamp.isoformat().encode(), repr(state.started).encode()]
+    for path, (device, inode) in state.directories.items():
+        fields.extend([b'%d:%d' % (device, inode), path])
+    with contextlib.suppress(OSError):
+        cache.store_bytes(name, b'\0'.join(fields))
@@ -61,6 +61,12 @@ class Target(config.Configurable, abc.ABC):
 
 
 class TargetContext(t.ContextManager['TargetContext']):
+    """
+    An open connection to a target.
+    Backups run their commands in worker threads,
+    so these methods may be called from several threads at once.
+    """
+
     @abc.abstractmethod
     def make_path(self, path: pathlib.Path) -> pathlib.Path:
         """
@@ -84,21 +90,55 @@ class TargetContext(t.ContextManager['TargetContext']):
     @abc.abstractmethod
     def list_directory(self, path: pathlib.Path) -> t.List[str]: ...
 
+    @property
+    def env(self) -> t.Optional[t.Mapping[str, str]]:
+        """
+        The environment to run rsync with when sending files to this target,
+        or None to use the current environment.
+        """
+        return None
+
     def list_backups(self, path: pathlib.Path) -> t.Iterable[Backup]:
         """
-        Find all the backups in a directory. A `(directory name, timestamp)`
-        tuple is returned for each backup directory found.
+        Find all the backups in a directory. A `Backup` with the directory name
+        and timestamp is returned for each backup directory found.
+
+        This checks and reads the timestamp file of every entry one at a time.
+        Targets where each of these is a round trip should override this
+        to find and read all the timestamp files at once,
+        passing each one through `parse_backup`.
         """
-        entries = self.list_directory(path)
-        for entry in entries:
+        for entry in self.list_directory(path):
+            if not is_backup_name(entry):
+                continue
             timestamp_file = path / entry / constants.TIMESTAMP_FILE_NAME
             if not self.exists(timestamp_file):
                 continue
-            content = self.read_file(timestamp_file).decode()
-            try:
-                yield Backup(name=entry, timestamp=iso8601.parse_date(content))
-            except ValueError:
-                continue
+            backup = parse_backup(entry, self.read_file(timestamp_file))
+            if backup is not None:
+                yield backup
+
+
+def is_backup_name(name: str) -> bool:
+    """
+    Check if a directory entry could be a backup,
+    as opposed to the `current` link or a backup waiting to be deleted.
+    """
+    # `current` is a link to the latest snapshot
+    current = constants.CURRENT_SNAPSHOT_NAME
+    if name == current or name.startswith(current + '.'):
+        return False
+    return not name.endswith(constants.DELETING_SUFFIX)
+
+
+def parse_backup(name: str, timestamp: bytes) -> t.Optional[Backup]:
+    """
+    Make a Backup from a directory name and the contents of its timestamp file.
+    """
+    try:
+        return Backup(name=name, timestamp=iso8601.parse_date(timestamp.decode()))
+    except ValueError:
+        return None
 
 
 target_types = registry.Registry[t.Type[Target]]()
@@ -1,8 +1,13 @@
 import contextlib
 import functools
+import os
 import pathlib
 import shlex
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import types
 import typing as t
 
@@ -12,7 +17,7 @@ import paramiko.ssh_exception
 import spur
 import spur.ssh
 
-from .. import exceptions, logging
+from .. import cache, constants, exceptions, logging
 from . import _base
 
 logger = logging.getLogger(__name__)
@@ -38,13 +43,8 @@ class SSH(_base.Target):
             raise exceptions.ConfigError(str(exc))
 
     def rsync_arguments(self, destination: pathlib.Path) -> t.Tuple[str, t.List[str]]:
-        options = []
-
-        ssh_options = []
-        if self.port:
-            ssh_options += ['-p', str(self.port)]
-        if ssh_options:
-            options += ['-e', shlex.join(['ssh'] + ssh_options)]
+        # The ssh command, including the port, is set by SSHContext.env
+        options: t.List[str] = []
 
         if self.username:
             target_str = f'{self.username}@{self.hostname}:{destination}'
@@ -63,6 +63,10 @@ class SSH(_base.Target):
 @attr.s(auto_attribs=True, kw_only=True)
 class SSHContext(_base.TargetContext):
     target: SSH
+    _control_dir: t.Optional[pathlib.Path] = attr.ib(default=None, init=False)
+    # Commands each open their own channel on the connection,
+    # but the SFTP client is shared and can only be used by one thread at a time
+    _sftp_lock: threading.Lock = attr.ib(factory=threading.Lock, init=False)
 
     @functools.cached_property
     def _stack(self) -> contextlib.ExitStack:
@@ -88,6 +92,7 @@ class SSHContext(_base.TargetContext):
         self._stack.enter_context(self.client)
         try:
             self._test_connection()
+            self._start_control_master()
         except Exception:
             self._stack.close()
             raise
@@ -125,6 +130,46 @@ class SSHContext(_base.TargetContext):
                 raise _base.ContextException(message) from exc
             raise _base.ContextException(str(exc)) from exc
 
+    def _start_control_master(self) -> None:
+        """
+        Make a directory for an SSH control socket,
+        so that every rsync run in this context shares one SSH connection.
+        The first rsync to connect becomes the master connection,
+        which is closed when this context exits.
+        """
+        cache_path = cache.get_default_cache_path()
+        cache_path.mkdir(parents=True, exist_ok=True)
+        self._control_dir = pathlib.Path(tempfile.mkdtemp(prefix='cm-', dir=cache_path))
+        self._stack.callback(self._stop_control_master)
+
+    def _stop_control_master(self) -> None:
+        if self._control_dir is None:
+            return
+        # This fails harmlessly if rsync never started a master connection
+        with contextlib.suppress(OSError):
+            subprocess.run(
+                [*self._ssh_command(), '-O', 'exit', self.target.hostname],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self._control_dir, ignore_errors=True)
+        self._control_dir = None
+
+    def _ssh_command(self) -> t.List[str]:
+        # Options are added to a remote shell command the user has already set for rsync
+        command = shlex.split(os.environ.get('RSYNC_RSH', 'ssh'))
+        if self.target.port:
+            command += ['-p', str(self.target.port)]
+        if self._control_dir is not None:
+            command += [
+                '-o', 'ControlMaster=auto',
+                '-o', f'ControlPath={self._control_dir / "socket"}',
+                '-o', 'ControlPersist=60',
+            ]
+        return command
+
+    @property
+    def env(self) -> t.Optional[t.Mapping[str, str]]:
+        return {**os.environ, 'RSYNC_RSH': shlex.join(self._ssh_command())}
+
     def make_path(self, path: pathlib.Path) -> pathlib.Path:
         if path.is_absolute():
             path = path.relative_to('/')
@@ -139,12 +184,36 @@ class SSHContext(_base.TargetContext):
         return t.cast(int, result.return_code) == 0
 
     def read_file(self, path: pathlib.Path) -> bytes:
-        with self.sftp.open(str(self.make_path(path)), 'rb') as f:
+        with self._sftp_lock, self.sftp.open(str(self.make_path(path)), 'rb') as f:
             return t.cast(bytes, f.read())
 
     def write_file(self, path: pathlib.Path, contents: bytes) -> None:
-        with self.sftp.open(str(self.make_path(path)), 'wb') as f:
+        with self._sftp_lock, self.sftp.open(str(self.make_path(path)), 'wb') as f:
             f.write(contents)
 
     def list_directory(self, path: pathlib.Path) -> t.List[str]:
-        return self.sftp.listdir(str(self.make_path(path)))
+        with self._sftp_lock:
+            return self.sftp.listdir(str(self.make_path(path)))
+
+    def list_backups(self, path: pathlib.Path) -> t.Iterable[_base.Backup]:
+        """
+        Find all the backups in a directory, reading every timestamp file
+        in a single command rather than a round trip per backup.
+        """
+        backup_path = str(self.make_path(path))
+        # Print the path of each timestamp file then its contents,
+        # each followed by a null byte.
+        script = 'for f; do printf "%s\\0" "$f"; cat "$f"; printf "\\0"; done'
+        result = self.client.run([
+            'find', backup_path, '-mindepth', '2', '-maxdepth', '2',
+            '-type', 'f', '-name', constants.TIMESTAMP_FILE_NAME,
+            '-exec', 'sh', '-c', script, 'sh', '{}', '+',
+        ], allow_error=True)
+        fields = t.cast(bytes, result.output).split(b'\0')
+        for timestamp_file, contents in zip(fields[0::2], fields[1::2]):
+            entry = pathlib.PurePosixPath(timestamp_file.decode()).parent.name
+            if not _base.is_backup_name(entry):
+                continue
+            backup = _base.parse_backup(entry, contents)
+            if backup is not None:
+                yield backup